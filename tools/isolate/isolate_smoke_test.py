@@ -3,10 +3,14 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import atexit
+import copy
 import cStringIO
+import functools
 import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
@@ -18,11 +22,19 @@ import unittest
 import isolate
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+# The platform doesn't change during the test run.
+FLAVOR = isolate.trace_inputs.get_flavor()
+# Environment to run isolate.py with. Computed once since it doesn't change.
+ISOLATE_ENV = dict(
+    (k, v) for k, v in os.environ.iteritems() if k != 'ISOLATE_DEBUG')
 VERBOSE = False
 
 
 # Keep the list hard coded.
 EXPECTED_MODES = ('check', 'hashtable', 'remap', 'run', 'trace')
+# Extracts the mode and the case from the test fixture and test method names.
+RE_MODE = re.compile(r'^Isolate_([a-z]+)$')
+RE_CASE = re.compile(r'^test_([a-z_]+)$')
 # These are per test case, not per mode.
 RELATIVE_CWD = {
   'fail': '.',
@@ -44,6 +56,58 @@ DEPENDENCIES = {
     'with_flag.py', 'files1/test_file1.txt', 'files1/test_file2.txt',
   ],
 }
+# Same as DEPENDENCIES but as sets, to be compared with _result_tree().
+DEPENDENCIES_SETS = dict(
+    (k, frozenset(v)) for k, v in DEPENDENCIES.iteritems())
+# Cache of _gen_files() results, keyed by (case, read_only, LEVEL). The
+# dependencies are not modified while the tests are running.
+_GEN_FILES_CACHE = {}
+
+
+# Lazily started isolate_worker.py process, shared by all the tests run in this
+# process.
+_ISOLATE_WORKER = None
+
+
+def _run_in_worker(args, cwd):
+  """Runs isolate.py with |args| in the shared isolate_worker.py process.
+
+  Returns a tuple (returncode, output) or None if the worker process died.
+  """
+  global _ISOLATE_WORKER
+  if not _ISOLATE_WORKER:
+    _ISOLATE_WORKER = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT_DIR, 'isolate_worker.py')],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        cwd=ROOT_DIR,
+        env=ISOLATE_ENV)
+  try:
+    _ISOLATE_WORKER.stdin.write(json.dumps({'args': args, 'cwd': cwd}) + '\n')
+    _ISOLATE_WORKER.stdin.flush()
+    line = _ISOLATE_WORKER.stdout.readline()
+  except IOError:
+    line = ''
+  if not line:
+    logging.warning('isolate_worker.py died, falling back to isolate.py')
+    _ISOLATE_WORKER.wait()
+    _ISOLATE_WORKER = None
+    return None
+  response = json.loads(line)
+  return response['returncode'], response['output'].encode('utf-8')
+
+
+def _stop_worker():
+  global _ISOLATE_WORKER
+  if _ISOLATE_WORKER:
+    _ISOLATE_WORKER.stdin.close()
+    _ISOLATE_WORKER.wait()
+    _ISOLATE_WORKER = None
+
+
+# tearDownModule() is not supported by python 2.6's unittest.
+atexit.register(_stop_worker)
+
 
 class CalledProcessError(subprocess.CalledProcessError):
   """Makes 2.6 version act like 2.7"""
@@ -62,6 +126,9 @@ class IsolateBase(unittest.TestCase):
   # To be defined by the subclass, it defines the amount of meta data saved by
   # isolate.py for each file. Should be one of (NO_INFO, STATS_ONLY, WITH_HASH).
   LEVEL = None
+  # Cached values of mode() and case().
+  _mode = None
+  _case = None
 
   def setUp(self):
     # The tests assume the current directory is the file's directory.
@@ -77,14 +144,21 @@ class IsolateBase(unittest.TestCase):
     self.assertFalse(os.path.exists(self.outdir))
 
   def _result_tree(self):
-    actual = []
+    """Returns the set of files in self.outdir, relative to it."""
+    actual = set()
+    prefix = len(self.outdir) + 1
     for root, _dirs, files in os.walk(self.outdir):
-      actual.extend(os.path.join(root, f)[len(self.outdir)+1:] for f in files)
-    return sorted(actual)
+      # Compute the relative directory once instead of once per file.
+      reldir = root[prefix:]
+      if reldir:
+        actual.update(os.path.join(reldir, f) for f in files)
+      else:
+        actual.update(files)
+    return actual
 
   def _expected_tree(self):
     """Verifies the files written in the temporary directory."""
-    self.assertEquals(sorted(DEPENDENCIES[self.case()]), self._result_tree())
+    self.assertEquals(DEPENDENCIES_SETS[self.case()], self._result_tree())
 
   @staticmethod
   def _fix_file_mode(filename, read_only):
@@ -95,28 +169,39 @@ class IsolateBase(unittest.TestCase):
     return (min_mode | 0111) if filename.endswith('.py') else min_mode
 
   def _gen_files(self, read_only):
+    # Only the truthiness of read_only affects the result.
+    key = (self.case(), bool(read_only), self.LEVEL)
+    if key not in _GEN_FILES_CACHE:
+      _GEN_FILES_CACHE[key] = self._gen_files_uncached(read_only)
+    return copy.deepcopy(_GEN_FILES_CACHE[key])
+
+  def _gen_files_uncached(self, read_only):
     root_dir = ROOT_DIR
     if RELATIVE_CWD[self.case()] == '.':
       root_dir = os.path.join(root_dir, 'data', 'isolate')
 
-    files = dict((unicode(f), {}) for f in DEPENDENCIES[self.case()])
-
-    if self.LEVEL >= isolate.STATS_ONLY:
-      for k, v in files.iteritems():
-        if isolate.trace_inputs.get_flavor() != 'win':
-          v[u'mode'] = self._fix_file_mode(k, read_only)
-        filestats = os.stat(os.path.join(root_dir, k))
+    files = {}
+    for filename in DEPENDENCIES[self.case()]:
+      filepath = os.path.join(root_dir, filename)
+      v = {}
+      if self.LEVEL >= isolate.STATS_ONLY:
+        if FLAVOR != 'win':
+          v[u'mode'] = self._fix_file_mode(filename, read_only)
+        filestats = os.stat(filepath)
         v[u'size'] = filestats.st_size
         # Used the skip recalculating the hash. Use the most recent update
         # time.
         v[u'timestamp'] = int(round(filestats.st_mtime))
 
-    if self.LEVEL >= isolate.WITH_HASH:
-      for filename in files:
+      if self.LEVEL >= isolate.WITH_HASH:
         # Calculate our hash.
         h = hashlib.sha1()
-        h.update(open(os.path.join(root_dir, filename), 'rb').read())
-        files[filename][u'sha-1'] = unicode(h.hexdigest())
+        with open(filepath, 'rb') as f:
+          # Hash in chunks to not load the whole file in memory at once.
+          for chunk in iter(functools.partial(f.read, 1024 * 1024), ''):
+            h.update(chunk)
+        v[u'sha-1'] = unicode(h.hexdigest())
+      files[unicode(filename)] = v
     return files
 
   def _expected_result(self, args, read_only):
@@ -125,13 +210,12 @@ class IsolateBase(unittest.TestCase):
       u'files': self._gen_files(read_only),
       u'relative_cwd': unicode(RELATIVE_CWD[self.case()]),
       u'read_only': read_only,
+      u'command': [unicode(x) for x in ['python'] + args] if args else [],
     }
-    if args:
-      expected[u'command'] = [u'python'] + [unicode(x) for x in args]
-    else:
-      expected[u'command'] = []
 
-    self.assertEquals(expected, json.load(open(self.result, 'rb')))
+    with open(self.result, 'rb') as f:
+      actual = json.loads(f.read())
+    self.assertEquals(expected, actual)
     return expected
 
   def _expect_no_result(self):
@@ -154,9 +238,15 @@ class IsolateBase(unittest.TestCase):
     ]
     cmd.extend(args)
 
-    env = os.environ.copy()
-    if 'ISOLATE_DEBUG' in env:
-      del env['ISOLATE_DEBUG']
+    cwd = ROOT_DIR
+    if need_output or not VERBOSE:
+      # Skip the python startup cost by reusing the same process.
+      result = _run_in_worker(cmd[2:], cwd)
+      if result:
+        returncode, out = result
+        if returncode:
+          raise CalledProcessError(returncode, cmd, out, cwd)
+        return out
 
     if need_output or not VERBOSE:
       stdout = subprocess.PIPE
@@ -166,13 +256,12 @@ class IsolateBase(unittest.TestCase):
       stdout = None
       stderr = None
 
-    cwd = ROOT_DIR
     p = subprocess.Popen(
         cmd,
         stdout=stdout,
         stderr=stderr,
         cwd=cwd,
-        env=env,
+        env=ISOLATE_ENV,
         universal_newlines=True)
     out = p.communicate()[0]
     if p.returncode:
@@ -181,15 +270,18 @@ class IsolateBase(unittest.TestCase):
 
   def mode(self):
     """Returns the execution mode corresponding to this test case."""
-    test_id = self.id().split('.')
-    self.assertEquals(3, len(test_id))
-    self.assertEquals('__main__', test_id[0])
-    return re.match('^Isolate_([a-z]+)$', test_id[1]).group(1)
+    if self._mode is None:
+      test_id = self.id().split('.')
+      self.assertEquals(3, len(test_id))
+      self.assertEquals('__main__', test_id[0])
+      self._mode = RE_MODE.match(test_id[1]).group(1)
+    return self._mode
 
   def case(self):
     """Returns the filename corresponding to this test case."""
-    test_id = self.id().split('.')
-    return re.match('^test_([a-z_]+)$', test_id[2]).group(1)
+    if self._case is None:
+      self._case = RE_CASE.match(self.id().split('.')[2]).group(1)
+    return self._case
 
   def filename(self):
     """Returns the filename corresponding to this test case."""
@@ -224,8 +316,8 @@ class Isolate(unittest.TestCase):
     )
     self.assertEquals(sorted(RELATIVE_CWD), files)
     self.assertEquals(sorted(DEPENDENCIES), files)
+    expected_cases = set('test_%s' % f for f in files)
     for mode in EXPECTED_MODES:
-      expected_cases = set('test_%s' % f for f in files)
       fixture_name = 'Isolate_%s' % mode
       fixture = getattr(sys.modules[__name__], fixture_name)
       actual_cases = set(i for i in dir(fixture) if i.startswith('test_'))
@@ -280,8 +372,9 @@ class Isolate_hashtable(IsolateBase):
 
   def _expected_hash_tree(self):
     """Verifies the files written in the temporary directory."""
-    expected = [v['sha-1'] for v in self._gen_files(False).itervalues()]
-    self.assertEquals(sorted(expected), self._result_tree())
+    # Files with the same content are stored only once.
+    expected = set(v['sha-1'] for v in self._gen_files(False).itervalues())
+    self.assertEquals(expected, self._result_tree())
 
   def test_fail(self):
     self._execute('hashtable', 'fail.isolate', [], False)
@@ -368,7 +461,7 @@ class Isolate_run(IsolateBase):
   LEVEL = isolate.STATS_ONLY
 
   def _expect_empty_tree(self):
-    self.assertEquals([], self._result_tree())
+    self.assertEquals(set(), self._result_tree())
 
   def test_fail(self):
     try:
@@ -479,7 +572,7 @@ class Isolate_trace(IsolateBase):
     self._expected_result(['touch_root.py'], None)
     expected = {
       'conditions': [
-        ['OS=="%s"' % isolate.trace_inputs.get_flavor(), {
+        ['OS=="%s"' % FLAVOR, {
           'variables': {
             isolate.trace_inputs.KEY_TRACKED: [
               'touch_root.py',
@@ -498,7 +591,7 @@ class Isolate_trace(IsolateBase):
     self._expected_result(['with_flag.py', 'trace'], None)
     expected = {
       'conditions': [
-        ['OS=="%s"' % isolate.trace_inputs.get_flavor(), {
+        ['OS=="%s"' % FLAVOR, {
           'variables': {
             isolate.trace_inputs.KEY_TRACKED: [
               'with_flag.py',
@@ -513,8 +606,79 @@ class Isolate_trace(IsolateBase):
     self.assertEquals(self._to_string(expected), out)
 
 
+def _iter_tests(suite):
+  """Flattens a unittest.TestSuite into its individual test cases."""
+  for test in suite:
+    if isinstance(test, unittest.TestSuite):
+      for i in _iter_tests(test):
+        yield i
+    else:
+      yield test
+
+
+def _run_shard(test_names):
+  """Runs a subset of the tests in a worker process.
+
+  Returns the runner output along the number of tests run, failures and errors
+  since unittest.TestResult can't be pickled back to the parent process.
+  """
+  suite = unittest.TestLoader().loadTestsFromNames(
+      test_names, sys.modules[__name__])
+  out = cStringIO.StringIO()
+  result = unittest.TextTestRunner(
+      stream=out, verbosity=2 if VERBOSE else 1).run(suite)
+  return (
+      out.getvalue(), result.testsRun, len(result.failures),
+      len(result.errors))
+
+
+def main(args):
+  """Runs the tests in parallel, each worker processing one shard of the tests.
+
+  Each test is independent and mostly waits for its isolate.py child process so
+  the shards are processed concurrently. A shard contains whole fixtures so
+  each fixture is set up only once.
+  """
+  loader = unittest.TestLoader()
+  module = sys.modules[__name__]
+  if args:
+    suite = loader.loadTestsFromNames(args, module)
+  else:
+    suite = loader.loadTestsFromModule(module)
+  # Strip the '__main__.' prefix so the names can be reloaded by the workers.
+  fixtures = {}
+  for test in _iter_tests(suite):
+    name = test.id().split('.', 1)[1]
+    fixtures.setdefault(name.split('.', 1)[0], []).append(name)
+  nb_shards = max(1, min(multiprocessing.cpu_count() - 2, len(fixtures)))
+  shards = [[] for _ in xrange(nb_shards)]
+  # Assign the largest fixtures first, each to the least loaded shard.
+  for fixture in sorted(fixtures, key=lambda x: (-len(fixtures[x]), x)):
+    min(shards, key=len).extend(fixtures[fixture])
+
+  pool = multiprocessing.Pool(nb_shards)
+  try:
+    results = pool.map(_run_shard, shards)
+  finally:
+    pool.close()
+    pool.join()
+
+  total = failures = errors = 0
+  for out, tests_run, shard_failures, shard_errors in results:
+    sys.stderr.write(out)
+    total += tests_run
+    failures += shard_failures
+    errors += shard_errors
+  sys.stderr.write('%s\nRan %d tests in %d shards\n\n' % (
+      '-' * 70, total, nb_shards))
+  if failures or errors:
+    sys.stderr.write('FAILED (failures=%d, errors=%d)\n' % (failures, errors))
+    return 1
+  sys.stderr.write('OK\n')
+  return 0
+
 
 if __name__ == '__main__':
   VERBOSE = '-v' in sys.argv
   logging.basicConfig(level=logging.DEBUG if VERBOSE else logging.ERROR)
-  unittest.main()
+  sys.exit(main([arg for arg in sys.argv[1:] if not arg.startswith('-')]))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# Copyright (c) 2012 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Runs isolate.py's main() repeatedly in the same process.
+
+Used by isolate_smoke_test.py to skip the python startup and module loading
+cost on each isolate.py invocation. Reads one json encoded request per line on
+stdin and writes one json encoded response per line on stdout.
+
+Request: {"args": [isolate.py arguments], "cwd": "directory"}
+Response: {"returncode": int, "output": "merged stdout and stderr"}
+"""
+
+import json
+import os
+import sys
+import tempfile
+import traceback
+
+import isolate
+
+
+def run_isolate(args, cwd):
+  """Runs isolate.main() with |args| from |cwd|.
+
+  Returns the exit code and the merged stdout and stderr output. The output is
+  redirected at the file descriptor level so the output of the child processes
+  started by isolate.py is captured too.
+  """
+  with tempfile.TemporaryFile() as output:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(0), os.dup(1), os.dup(2)]
+    null = os.open(os.devnull, os.O_RDONLY)
+    # Do not let the child processes read the requests.
+    os.dup2(null, 0)
+    os.close(null)
+    os.dup2(output.fileno(), 1)
+    os.dup2(output.fileno(), 2)
+    old_argv = sys.argv
+    sys.argv = [isolate.__file__] + args
+    try:
+      os.chdir(cwd)
+      try:
+        returncode = isolate.main()
+      except SystemExit, e:
+        if e.code is None or isinstance(e.code, int):
+          returncode = e.code or 0
+        else:
+          print >> sys.stderr, e.code
+          returncode = 1
+      except Exception:  # pylint: disable=W0703
+        traceback.print_exc()
+        returncode = 1
+    finally:
+      sys.argv = old_argv
+      sys.stdout.flush()
+      sys.stderr.flush()
+      for fd, saved_fd in enumerate(saved_fds):
+        os.dup2(saved_fd, fd)
+        os.close(saved_fd)
+    output.seek(0)
+    return returncode, output.read().replace('\r\n', '\n')
+
+
+def main():
+  for line in iter(sys.stdin.readline, ''):
+    request = json.loads(line)
+    returncode, output = run_isolate(request['args'], request['cwd'])
+    response = {
+      'returncode': returncode,
+      'output': output.decode('utf-8', 'replace'),
+    }
+    sys.stdout.write(json.dumps(response) + '\n')
+    sys.stdout.flush()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -12,14 +12,19 @@ dependencies list more compact.
 """
 
 import codecs
+import collections
 import csv
+import heapq
 import logging
+import multiprocessing
 import optparse
 import os
 import posixpath
 import re
+import shutil
 import subprocess
 import sys
+import threading
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -28,6 +33,10 @@ ROOT_DIR = os.path.dirname(os.path.dirname(BASE_DIR))
 KEY_TRACKED = 'isolate_dependency_tracked'
 KEY_UNTRACKED = 'isolate_dependency_untracked'
 
+# Buffer size used to read and copy the trace logs, which can be large. Larger
+# buffers do not read faster.
+LOG_BUFFER_SIZE = 1024 * 1024
+
 
 if sys.platform == 'win32':
   from ctypes.wintypes import create_unicode_buffer
@@ -80,6 +89,8 @@ if sys.platform == 'win32':
     """Maps \Device\HarddiskVolumeN to N: on Windows."""
     # Keep one global cache.
     _MAPPING = {}
+    # Splits a native NT path into its device and its path.
+    RE_NT_PATH = re.compile(r'(^\\Device\\[a-zA-Z0-9]+)(\\.*)?$')
 
     def __init__(self):
       if not self._MAPPING:
@@ -97,7 +108,7 @@ if sys.platform == 'win32':
 
     def to_dos(self, path):
       """Converts a native NT path to DOS path."""
-      m = re.match(r'(^\\Device\\[a-zA-Z0-9]+)(\\.*)?$', path)
+      m = self.RE_NT_PATH.match(path)
       if not m or m.group(1) not in self._MAPPING:
         assert False, path
       drive = self._MAPPING[m.group(1)]
@@ -123,6 +134,45 @@ def isEnabledFor(level):
   return logging.getLogger().isEnabledFor(level)
 
 
+def _read_tail(pipe, tail):
+  """Reads |pipe| until EOF, only keeping the lines that fit in |tail|."""
+  tail.extend(iter(pipe.readline, ''))
+  pipe.close()
+
+
+def communicate_tail(child, data=None, lines=100):
+  """Same as child.communicate(data) but only keeps the last |lines| lines of
+  stdout and stderr.
+
+  The output of a noisy child is only printed on failure so there is no point
+  in keeping all of it in memory.
+  """
+  tails = []
+  threads = []
+  for pipe in (child.stdout, child.stderr):
+    tail = collections.deque(maxlen=lines)
+    tails.append(tail)
+    if pipe:
+      thread = threading.Thread(target=_read_tail, args=(pipe, tail))
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+  if child.stdin:
+    try:
+      if data:
+        child.stdin.write(data)
+      child.stdin.close()
+    except IOError:
+      # The child may have exited without reading its input.
+      pass
+  for thread in threads:
+    thread.join()
+  child.wait()
+  out = ''.join(tails[0]) if child.stdout else None
+  err = ''.join(tails[1]) if child.stderr else None
+  return out, err
+
+
 def fix_python_path(cmd):
   """Returns the fixed command line to call the right python executable."""
   out = cmd[:]
@@ -133,6 +183,33 @@ def fix_python_path(cmd):
   return out
 
 
+def realpaths(paths, dirs=None):
+  """Returns the set of os.path.realpath() of each path in |paths|.
+
+  Each path is resolved from its resolved parent directory so each directory is
+  only resolved once and only the last component of a path is checked for a
+  symlink. |dirs| caches the resolved paths and can be shared across calls.
+  """
+  if dirs is None:
+    dirs = {}
+
+  def resolve(path):
+    """Returns os.path.realpath(path), reusing the cached parents."""
+    resolved = dirs.get(path)
+    if resolved is None:
+      parent, name = os.path.split(path)
+      if not name or name in (os.curdir, os.pardir):
+        resolved = os.path.realpath(path)
+      else:
+        resolved = os.path.join(resolve(parent), name)
+        if os.path.islink(resolved):
+          resolved = os.path.realpath(resolved)
+      dirs[path] = resolved
+    return resolved
+
+  return set(resolve(path) for path in paths)
+
+
 def posix_relpath(path, root):
   """posix.relpath() that keeps trailing slash."""
   out = posixpath.relpath(path, root)
@@ -154,6 +231,8 @@ class Strace(object):
     '/usr',
     '/var',
   )
+  # Logs at least this large are parsed by multiple processes.
+  PARALLEL_PARSE_SIZE = 64 * 1024 * 1024
 
   class _Context(object):
     """Processes a strace log line and keeps the list of existent and non
@@ -161,19 +240,22 @@ class Strace(object):
 
     Ignores directories.
     """
-    # This is the most common format. pid function(args) = result
+    # Parses all the kinds of lines in one pass:
+    # - A process received a signal.
+    # - A process didn't handle a signal.
+    # - A resumed function call.
+    # - The most common format, pid function(args) = result
+    RE_LINE = re.compile(
+        r'^(\d+)\s+(?:'
+        r'(--- SIG[A-Z]+ .+ ---)|'
+        r'\+\+\+ killed by ([A-Z]+) \+\+\+$|'
+        r'<\.\.\. ([^ ]+) resumed> (.+)$|'
+        r'([^\(]+)\((.+?)\)\s+= (.+)$)')
+    # Used to parse a resumed function call once reconstructed.
     RE_HEADER = re.compile(r'^(\d+)\s+([^\(]+)\((.+?)\)\s+= (.+)$')
     # An interrupted function call, only grab the minimal header.
     RE_UNFINISHED = re.compile(r'^(\d+)\s+([^\(]+).*$')
     UNFINISHED = ' <unfinished ...>'
-    # A resumed function call.
-    RE_RESUMED = re.compile(r'^(\d+)\s+<\.\.\. ([^ ]+) resumed> (.+)$')
-    # A process received a signal.
-    RE_SIGNAL = re.compile(r'^\d+\s+--- SIG[A-Z]+ .+ ---')
-    # A process didn't handle a signal.
-    RE_KILLED = re.compile(r'^(\d+)\s+\+\+\+ killed by ([A-Z]+) \+\+\+$')
-    # A call was canceled.
-    RE_UNAVAILABLE = re.compile(r'\)\s+= \? <unavailable>$')
 
     # Arguments parsing.
     RE_CHDIR = re.compile(r'^\"(.+?)\"$')
@@ -185,10 +267,32 @@ class Strace(object):
     def __init__(self, blacklist):
       self._cwd = {}
       self.blacklist = blacklist
-      self.files = set()
-      self.non_existent = set()
+      # Checked once, most of the debug messages are in the hot paths.
+      self._debug = isEnabledFor(logging.DEBUG)
+      # Maps each path accessed to True if it is a file, False if it doesn't
+      # exist and None if it is blacklisted. A single dict is smaller and faster
+      # to look up than one set per state.
+      self._paths = {}
       # Key is a tuple(pid, function name)
       self._pending_calls = {}
+      # Handler of each traced function, keyed by the function name as found in
+      # the log.
+      self._handlers = dict(
+          (name, getattr(self, 'handle_%s' % name)) for name in self.traces())
+
+    @property
+    def files(self):
+      """Returns the existing files accessed."""
+      return set(k for k, v in self._paths.iteritems() if v is True)
+
+    @property
+    def non_existent(self):
+      """Returns the files accessed that do not exist."""
+      return set(k for k, v in self._paths.iteritems() if v is False)
+
+    def merge(self, paths):
+      """Adds the paths found by the _Context of another process."""
+      self._paths.update(paths)
 
     @classmethod
     def traces(cls):
@@ -197,15 +301,6 @@ class Strace(object):
 
     def on_line(self, line):
       line = line.strip()
-      if self.RE_SIGNAL.match(line):
-        # Ignore signals.
-        return
-
-      m = self.RE_KILLED.match(line)
-      if m:
-        self.handle_exit_group(int(m.group(1)), m.group(2), None, None)
-        return
-
       if line.endswith(self.UNFINISHED):
         line = line[:-len(self.UNFINISHED)]
         m = self.RE_UNFINISHED.match(line)
@@ -213,27 +308,40 @@ class Strace(object):
         self._pending_calls[(m.group(1), m.group(2))] = line
         return
 
-      m = self.RE_UNAVAILABLE.match(line)
-      if m:
-        # This usually means a process was killed and a pending call was
-        # canceled.
-        # TODO(maruel): Look up the last exit_group() trace just above and make
-        # sure any self._pending_calls[(pid, anything)] is properly flushed.
+      # Fast path for the most common format, pid function(args) = result.
+      # Splitting with str.find() doesn't backtrack like the non-greedy args
+      # group of the regexp does, which is slow on long lines.
+      pid, rest = line.split(None, 1)
+      paren = rest.find('(')
+      equal = rest.rfind(' = ')
+      if paren > 0 and equal > paren and rest[0] not in '<-+':
+        args = rest[paren + 1:equal].rstrip()
+        if len(args) > 1 and args.endswith(')') and pid.isdigit():
+          function = rest[:paren]
+          return self._handlers[function](
+              int(pid), function, args[:-1], rest[equal + 3:])
+
+      m = self.RE_LINE.match(line)
+      assert m, line
+      (pid, signal, killed, resumed_function, resumed_args, function, args,
+          result) = m.groups()
+      if signal:
+        # Ignore signals.
+        return
+
+      if killed:
+        self.handle_exit_group(int(pid), killed, None, None)
         return
 
-      m = self.RE_RESUMED.match(line)
-      if m:
-        pending = self._pending_calls.pop((m.group(1), m.group(2)))
+      if resumed_function:
+        pending = self._pending_calls.pop((pid, resumed_function))
         # Reconstruct the line.
-        line = pending + m.group(3)
+        line = pending + resumed_args
+        m = self.RE_HEADER.match(line)
+        assert m, line
+        pid, function, args, result = m.groups()
 
-      m = self.RE_HEADER.match(line)
-      assert m, line
-      return getattr(self, 'handle_%s' % m.group(2))(
-          int(m.group(1)),
-          m.group(2),
-          m.group(3),
-          m.group(4))
+      return self._handlers[function](int(pid), function, args, result)
 
     def handle_chdir(self, pid, _function, args, result):
       """Updates cwd."""
@@ -241,10 +349,12 @@ class Strace(object):
         cwd = self.RE_CHDIR.match(args).group(1)
         if not cwd.startswith('/'):
           cwd2 = os.path.join(self._cwd[pid], cwd)
-          logging.debug('handle_chdir(%d, %s) -> %s' % (pid, cwd, cwd2))
+          if self._debug:
+            logging.debug('handle_chdir(%d, %s) -> %s' % (pid, cwd, cwd2))
           self._cwd[pid] = cwd2
         else:
-          logging.debug('handle_chdir(%d, %s)' % (pid, cwd))
+          if self._debug:
+            logging.debug('handle_chdir(%d, %s)' % (pid, cwd))
           self._cwd[pid] = cwd
       else:
         assert False, 'Unexecpected fail: %s' % result
@@ -260,6 +370,9 @@ class Strace(object):
 
     def handle_exit_group(self, pid, _function, _args, _result):
       """Removes cwd."""
+      # TODO(maruel): A call returning '? <unavailable>' usually means a
+      # process was killed and a pending call was canceled. Make sure any
+      # self._pending_calls[(pid, anything)] is properly flushed here.
       del self._cwd[pid]
 
     @staticmethod
@@ -290,19 +403,87 @@ class Strace(object):
         return
       old_filepath = filepath
       if not filepath.startswith('/'):
-        filepath = os.path.join(self._cwd[pid], filepath)
+        cwd = self._cwd[pid]
+        if not cwd.endswith('/'):
+          cwd += '/'
+        filepath = cwd + filepath
+      # Files are usually opened many times, only run the blacklist once per
+      # path.
+      if filepath in self._paths:
+        return
       if self.blacklist(filepath):
+        self._paths[filepath] = None
         return
-      if old_filepath != filepath:
-        logging.debug(
-            '_handle_file(%d, %s) -> %s' % (pid, old_filepath, filepath))
-      else:
-        logging.debug('_handle_file(%d, %s)' % (pid, filepath))
-      if filepath not in self.files and filepath not in self.non_existent:
-        if os.path.isfile(filepath):
-          self.files.add(filepath)
+      if self._debug:
+        if old_filepath != filepath:
+          logging.debug(
+              '_handle_file(%d, %s) -> %s' % (pid, old_filepath, filepath))
         else:
-          self.non_existent.add(filepath)
+          logging.debug('_handle_file(%d, %s)' % (pid, filepath))
+      self._paths[filepath] = os.path.isfile(filepath)
+
+  class _CwdContext(_Context):
+    """Only replays the chdir() and clone() calls of a strace log to find the
+    cwd each child process starts with.
+    """
+    # pylint: disable=W0212
+    def __init__(self):
+      super(Strace._CwdContext, self).__init__(lambda _: True)
+      self.initial_cwd = {}
+      # Set when a pid is used by more than one process.
+      self.reused_pid = False
+
+    def on_line(self, line):
+      # Only look at the lines that could affect the cwd.
+      if 'chdir' in line or 'clone' in line:
+        super(Strace._CwdContext, self).on_line(line)
+
+    def handle_clone(self, pid, function, args, result):
+      super(Strace._CwdContext, self).handle_clone(pid, function, args, result)
+      if result == '? ERESTARTNOINTR (To be restarted)':
+        return
+      child = int(result)
+      if child in self.initial_cwd:
+        self.reused_pid = True
+      self.initial_cwd[child] = self._cwd[child]
+
+  @classmethod
+  def _parse_log_parallel(cls, filename, blacklist, jobs):
+    """Parses a strace log with |jobs| processes, each handling the pids equal
+    to its index modulo |jobs|.
+
+    The cwd a child process inherits from its parent is the only state shared
+    across pids so it is found first in a single pass. |blacklist| is sent to
+    the processes so it must be picklable.
+
+    Each process reads the whole log and skips the lines of the other pids.
+    Splitting the log by pid in the first pass instead would write a copy of the
+    log and make that pass serial work several times slower than re-reading the
+    log from the page cache in parallel.
+
+    Returns the merged _Context._paths or None when the log can't be split by
+    pid.
+    """
+    cwd_context = cls._CwdContext()
+    for line in open(filename, 'rb', LOG_BUFFER_SIZE):
+      cwd_context.on_line(line)
+    if cwd_context.reused_pid:
+      logging.info('A pid was reused, parsing the log in a single process')
+      return None
+    pool = multiprocessing.Pool(jobs)
+    try:
+      results = pool.map(
+          _strace_parse_pids,
+          [
+            (filename, blacklist, i, jobs, cwd_context.initial_cwd)
+            for i in xrange(jobs)
+          ])
+    finally:
+      pool.terminate()
+    paths = {}
+    for result in results:
+      paths.update(result)
+    return paths
 
   @classmethod
   def gen_trace(cls, cmd, cwd, logname):
@@ -316,26 +497,32 @@ class Strace(object):
     trace_cmd = ['strace', '-f', '-e', 'trace=%s' % traces, '-o', logname]
     child = subprocess.Popen(
         trace_cmd + cmd, cwd=cwd, stdout=stdout, stderr=stderr)
-    out, err = child.communicate()
+    out, err = communicate_tail(child)
     # Once it's done, inject a chdir() call to cwd to be able to reconstruct
     # the full paths.
     # TODO(maruel): cwd should be saved at each process creation, so forks needs
     # to be traced properly.
     if os.path.isfile(logname):
-      with open(logname) as f:
-        content = f.read()
-      with open(logname, 'w') as f:
-        pid = content.split(' ', 1)[0]
-        f.write('%s chdir("%s") = 0\n' % (pid, cwd))
-        f.write(content)
+      # Stream the log instead of loading it in memory, it can be large.
+      tmp_logname = logname + '.tmp'
+      os.rename(logname, tmp_logname)
+      try:
+        with open(tmp_logname, 'rb') as src:
+          first_line = src.readline()
+          pid = first_line.split(' ', 1)[0]
+          with open(logname, 'wb') as dst:
+            dst.write('%s chdir("%s") = 0\n' % (pid, cwd))
+            dst.write(first_line)
+            shutil.copyfileobj(src, dst, LOG_BUFFER_SIZE)
+      finally:
+        os.remove(tmp_logname)
 
     if child.returncode != 0:
       print 'Failure: %d' % child.returncode
-      # pylint: disable=E1103
       if out:
-        print ''.join(out.splitlines(True)[-100:])
+        print out
       if err:
-        print ''.join(err.splitlines(True)[-100:])
+        print err
     return child.returncode
 
   @classmethod
@@ -347,15 +534,44 @@ class Strace(object):
 
     Most of the time, files that do not exist are temporary test files that
     should be put in /tmp instead. See http://crbug.com/116251
+
+    |blacklist| must be picklable, large logs are parsed by multiple processes.
     """
     logging.info('parse_log(%s, %s)' % (filename, blacklist))
     context = cls._Context(blacklist)
-    for line in open(filename):
-      context.on_line(line)
+    paths = None
+    jobs = multiprocessing.cpu_count()
+    if jobs > 1 and os.path.getsize(filename) >= cls.PARALLEL_PARSE_SIZE:
+      paths = cls._parse_log_parallel(filename, blacklist, jobs)
+    if paths is None:
+      # Bind the method once, it is called for each line of the log.
+      on_line = context.on_line
+      for line in open(filename, 'rb', LOG_BUFFER_SIZE):
+        on_line(line)
+    else:
+      context.merge(paths)
     # Resolve any symlink we hit.
+    dirs = {}
     return (
-        set(os.path.realpath(f) for f in context.files),
-        set(os.path.realpath(f) for f in context.non_existent))
+        realpaths(context.files, dirs),
+        realpaths(context.non_existent, dirs))
+
+
+def _strace_parse_pids(args):
+  """Parses the lines of the pids equal to |index| modulo |jobs| of a strace
+  log.
+
+  Runs in a multiprocessing.Pool worker so it must be a module level function.
+  See Strace._parse_log_parallel().
+  """
+  filename, blacklist, index, jobs, initial_cwd = args
+  context = Strace._Context(blacklist)  # pylint: disable=W0212
+  context._cwd.update(initial_cwd)  # pylint: disable=W0212
+  on_line = context.on_line
+  for line in open(filename, 'rb', LOG_BUFFER_SIZE):
+    if int(line.split(None, 1)[0]) % jobs == index:
+      on_line(line)
+  return context._paths  # pylint: disable=W0212
 
 
 class Dtrace(object):
@@ -481,6 +697,21 @@ class Dtrace(object):
       */
       """
 
+  # Prepended to D_CODE by code(). It is formatted with the % operator so the
+  # printf() format specifiers are escaped.
+  D_CODE_BEGIN = (
+      'dtrace:::BEGIN {\n'
+      '  current_processes = 1;\n'
+      '  logindex = 0;\n'
+      '  trackedpid[%(pid)d] = 1;\n'
+      '  printf("%%d %%d:%%d chdir(\\"%(cwd)s\\") = 0\\n",\n'
+      '      logindex, 1, %(pid)d);\n'
+      '  logindex++;\n'
+      '  printf("%%d %%d:%%d %%s_%%s() = 0\\n",\n'
+      '      logindex, ppid, pid, probeprov, probename);\n'
+      '  logindex++;\n'
+      '}\n')
+
   @classmethod
   def code(cls, pid, cwd):
     """Setups the D code to implement child process tracking.
@@ -493,20 +724,8 @@ class Dtrace(object):
     Since the child process is already started, initialize current_processes to
     1.
     """
-    pid = str(pid)
     cwd = os.path.realpath(cwd).replace('\\', '\\\\').replace('%', '%%')
-    return (
-        'dtrace:::BEGIN {\n'
-        '  current_processes = 1;\n'
-        '  logindex = 0;\n'
-        '  trackedpid[') + pid + ('] = 1;\n'
-        '  printf("%d %d:%d chdir(\\"' + cwd + '\\") = 0\\n",\n'
-        '      logindex, 1, ' + pid + ');\n'
-        '  logindex++;\n'
-        '  printf("%d %d:%d %s_%s() = 0\\n",\n'
-        '      logindex, ppid, pid, probeprov, probename);\n'
-        '  logindex++;\n'
-        '}\n') + cls.D_CODE
+    return cls.D_CODE_BEGIN % {'pid': pid, 'cwd': cwd} + cls.D_CODE
 
   class _Context(object):
     """Processes a dtrace log line and keeps the list of existent and non
@@ -531,22 +750,36 @@ class Dtrace(object):
       # saved.
       self._cwd = {}
       self.blacklist = blacklist
-      self.files = set()
-      self.non_existent = set()
+      # Checked once, most of the debug messages are in the hot paths.
+      self._debug = isEnabledFor(logging.DEBUG)
+      # Maps each path accessed to True if it is a file, False if it doesn't
+      # exist and None if it is a directory or blacklisted, which are ignored.
+      self._paths = {}
+      # Handler of each function name seen, to not look it up on each line.
+      self._handlers = {}
+
+    @property
+    def files(self):
+      """Returns the existing files accessed."""
+      return set(k for k, v in self._paths.iteritems() if v is True)
+
+    @property
+    def non_existent(self):
+      """Returns the files accessed that do not exist."""
+      return set(k for k, v in self._paths.iteritems() if v is False)
 
     def on_line(self, line):
       m = self.RE_HEADER.match(line)
       assert m, line
-      fn = getattr(
-          self,
-          'handle_%s' % m.group(3).replace('-', '_'),
-          self._handle_ignored)
-      return fn(
-          int(m.group(1)),
-          int(m.group(2)),
-          m.group(3),
-          m.group(4),
-          m.group(5))
+      ppid, pid, function, args, result = m.groups()
+      fn = self._handlers.get(function)
+      if fn is None:
+        fn = getattr(
+            self,
+            'handle_%s' % function.replace('-', '_'),
+            self._handle_ignored)
+        self._handlers[function] = fn
+      return fn(int(ppid), int(pid), function, args, result)
 
     def handle_dtrace_BEGIN(self, _ppid, _pid, _function, args, _result):
       pass
@@ -566,10 +799,12 @@ class Dtrace(object):
         cwd = self.RE_CHDIR.match(args).group(1)
         if not cwd.startswith('/'):
           cwd2 = os.path.join(self._cwd[pid], cwd)
-          logging.debug('handle_chdir(%d, %s) -> %s' % (pid, cwd, cwd2))
+          if self._debug:
+            logging.debug('handle_chdir(%d, %s) -> %s' % (pid, cwd, cwd2))
           self._cwd[pid] = cwd2
         else:
-          logging.debug('handle_chdir(%d, %s)' % (pid, cwd))
+          if self._debug:
+            logging.debug('handle_chdir(%d, %s)' % (pid, cwd))
           self._cwd[pid] = cwd
       else:
         assert False, 'Unexecpected fail: %s' % result
@@ -595,28 +830,35 @@ class Dtrace(object):
         return
       orig_filepath = filepath
       if not filepath.startswith('/'):
-        filepath = os.path.join(self._cwd[pid], filepath)
-      filepath = os.path.normpath(filepath)
+        cwd = self._cwd[pid]
+        if not cwd.endswith('/'):
+          cwd += '/'
+        filepath = cwd + filepath
+      # Only normalize the path when needed, most paths are already normalized.
+      if '/.' in filepath or '//' in filepath or filepath.endswith('/'):
+        filepath = os.path.normpath(filepath)
+      # Only hit the blacklist and the file system once per path.
+      if filepath in self._paths:
+        return
       if self.blacklist(filepath):
+        self._paths[filepath] = None
         return
       # Sadly, still need to filter out directories here;
       # saw open_nocancel(".", 0, 0) = 0 lines.
-      if (filepath not in self.files and
-          filepath not in self.non_existent and
-          not os.path.isdir(filepath)):
+      if os.path.isdir(filepath):
+        self._paths[filepath] = None
+        return
+      if self._debug:
         if orig_filepath:
           logging.debug(
               '_handle_file(%d, %s) -> %s' % (pid, orig_filepath, filepath))
         else:
           logging.debug('_handle_file(%d, %s)' % (pid, filepath))
-        if os.path.isfile(filepath):
-          self.files.add(filepath)
-        else:
-          self.non_existent.add(filepath)
+      self._paths[filepath] = os.path.isfile(filepath)
 
-    @staticmethod
-    def _handle_ignored(_ppid, pid, function, args, result):
-      logging.debug('%d %s(%s) = %s' % (pid, function, args, result))
+    def _handle_ignored(self, _ppid, pid, function, args, result):
+      if self._debug:
+        logging.debug('%d %s(%s) = %s' % (pid, function, args, result))
 
   @classmethod
   def gen_trace(cls, cmd, cwd, logname):
@@ -671,7 +913,7 @@ class Dtrace(object):
       # Part 4: We can now tell our child to go.
       # TODO(maruel): Another pipe than stdin could be used instead. This would
       # be more consistent with the other tracing methods.
-      out, err = child.communicate(signal)
+      out, err = communicate_tail(child, signal)
 
       dtrace.wait()
       if dtrace.returncode != 0:
@@ -686,11 +928,10 @@ class Dtrace(object):
         cls._sort_log(logname)
       if child.returncode != 0:
         print 'Failure: %d' % child.returncode
-        # pylint: disable=E1103
         if out:
-          print ''.join(out.splitlines(True)[-100:])
+          print out
         if err:
-          print ''.join(err.splitlines(True)[-100:])
+          print err
     except KeyboardInterrupt:
       # Still sort when testing.
       cls._sort_log(logname)
@@ -710,12 +951,15 @@ class Dtrace(object):
     """
     logging.info('parse_log(%s, %s)' % (filename, blacklist))
     context = cls._Context(blacklist)
-    for line in open(filename, 'rb'):
-      context.on_line(line)
+    # Bind the method once, it is called for each line of the log.
+    on_line = context.on_line
+    for line in open(filename, 'rb', LOG_BUFFER_SIZE):
+      on_line(line)
     # Resolve any symlink we hit.
+    dirs = {}
     return (
-        set(os.path.realpath(f) for f in context.files),
-        set(os.path.realpath(f) for f in context.non_existent))
+        realpaths(context.files, dirs),
+        realpaths(context.non_existent, dirs))
 
   @staticmethod
   def _sort_log(logname):
@@ -724,17 +968,43 @@ class Dtrace(object):
     dtrace doesn't save the buffer in strict order since it keeps one buffer per
     CPU.
     """
-    with open(logname, 'rb') as logfile:
-      lines = [f for f in logfile.readlines() if f.strip()]
-    lines = sorted(lines, key=lambda l: int(l.split(' ', 1)[0]))
-    with open(logname, 'wb') as logfile:
-      logfile.write(''.join(lines))
+    env = os.environ.copy()
+    env['LC_ALL'] = 'C'
+    tmp_logname = logname + '.tmp'
+    try:
+      # sort(1) doesn't need to hold the whole log in memory. -s keeps the lines
+      # with the same timestamp in the order they were logged.
+      subprocess.check_call(
+          ['sort', '-n', '-s', '-k1,1', '-o', tmp_logname, logname], env=env)
+    except (OSError, subprocess.CalledProcessError), e:
+      logging.warning('sort(1) failed, sorting in memory: %s' % e)
+      if os.path.isfile(tmp_logname):
+        os.remove(tmp_logname)
+      with open(logname, 'rb', LOG_BUFFER_SIZE) as logfile:
+        lines = [l for l in logfile if l.strip()]
+      # Sort in-place and write the lines back one by one to not hold multiple
+      # copies of the log in memory.
+      lines.sort(key=lambda l: int(l.split(' ', 1)[0]))
+      with open(logname, 'wb') as logfile:
+        logfile.writelines(lines)
+      return
+
+    # Strip the empty lines while copying the sorted log back.
+    try:
+      with open(tmp_logname, 'rb', LOG_BUFFER_SIZE) as src:
+        with open(logname, 'wb') as dst:
+          dst.writelines(l for l in src if l.strip())
+    finally:
+      os.remove(tmp_logname)
 
 
 class LogmanTrace(object):
   """Uses the native Windows ETW based tracing functionality to trace a child
   process.
   """
+  # 'ANSI' csv logs at least this large are parsed by multiple processes.
+  PARALLEL_PARSE_SIZE = 64 * 1024 * 1024
+
   class _Context(object):
     """Processes a ETW log line and keeps the list of existent and non
     existent files accessed.
@@ -753,13 +1023,47 @@ class LogmanTrace(object):
 
     def __init__(self, blacklist):
       self.blacklist = blacklist
-      self.files = set()
-      self.non_existent = set()
+      # Checked once, most of the debug messages are in the hot paths.
+      self._debug = isEnabledFor(logging.DEBUG)
+      # Maps each path accessed to True if it is a file, False if it doesn't
+      # exist and None if it is a directory or blacklisted, which are ignored.
+      self._paths = {}
 
       self._processes = set()
       self._drive_map = DosDriveMap()
+      # Lower case DOS path of each quoted NT path seen, the same files are
+      # usually opened many times.
+      self._dos_paths = {}
       self._first_line = False
 
+      # Dispatch tables of the handle_<Event Name>_<Type> methods, keyed by
+      # (Event Name, Type), and of the handle_<Event Name>_Any fallbacks,
+      # keyed by Event Name. Computed once instead of on each line.
+      self._handlers = {}
+      self._fallback_handlers = {}
+      prefix = 'handle_'
+      for name in dir(self):
+        if name.startswith(prefix):
+          event_name, event_type = name[len(prefix):].split('_', 1)
+          handler = getattr(self, name)
+          self._handlers[(event_name, event_type)] = handler
+          if event_type == 'Any':
+            self._fallback_handlers[event_name] = handler
+
+    @property
+    def files(self):
+      """Returns the existing files accessed."""
+      return set(k for k, v in self._paths.iteritems() if v is True)
+
+    @property
+    def non_existent(self):
+      """Returns the files accessed that do not exist."""
+      return set(k for k, v in self._paths.iteritems() if v is False)
+
+    def merge(self, paths):
+      """Adds the paths found by the _Context of another process."""
+      self._paths.update(paths)
+
     def on_csv_line(self, line):
       """Processes a CSV Event line."""
       # So much white space!
@@ -820,13 +1124,10 @@ class LogmanTrace(object):
       line[self.PID] = int(line[self.PID], 16)
 
       # By Opcode
-      handler = getattr(
-          self,
-          'handle_%s_%s' % (line[self.EVENT_NAME], line[self.TYPE]),
-          None)
+      handler = self._handlers.get((line[self.EVENT_NAME], line[self.TYPE]))
       if not handler:
         # Try to get an universal fallback
-        handler = getattr(self, 'handle_%s_Any' % line[self.EVENT_NAME], None)
+        handler = self._fallback_handlers.get(line[self.EVENT_NAME])
       if handler:
         handler(line)
       else:
@@ -836,8 +1137,15 @@ class LogmanTrace(object):
       pass
 
     def handle_FileIo_Create(self, line):
-      m = re.match(r'^\"(.+)\"$', line[self.FILE_PATH])
-      self._handle_file(self._drive_map.to_dos(m.group(1)).lower())
+      filepath = line[self.FILE_PATH]
+      dos_path = self._dos_paths.get(filepath)
+      if dos_path is None:
+        # The path is always quoted, strip the quotes.
+        assert len(filepath) > 2 and filepath[0] == filepath[-1] == '"', (
+            filepath)
+        dos_path = self._drive_map.to_dos(filepath[1:-1]).lower()
+        self._dos_paths[filepath] = dos_path
+      self._handle_file(dos_path)
 
     def handle_FileIo_Rename(self, line):
       # TODO(maruel): Handle?
@@ -900,16 +1208,18 @@ class LogmanTrace(object):
 
       Interestingly enough, the file is always with an absolute path.
       """
-      if (self.blacklist(filename) or
-          os.path.isdir(filename) or
-          filename in self.files or
-          filename in self.non_existent):
+      # Only hit the blacklist and the file system once per path.
+      if filename in self._paths:
         return
-      logging.debug('_handle_file(%s)' % filename)
-      if os.path.isfile(filename):
-        self.files.add(filename)
-      else:
-        self.non_existent.add(filename)
+      if self.blacklist(filename):
+        self._paths[filename] = None
+        return
+      if os.path.isdir(filename):
+        self._paths[filename] = None
+        return
+      if self._debug:
+        logging.debug('_handle_file(%s)' % filename)
+      self._paths[filename] = os.path.isfile(filename)
 
   def __init__(self):
     # Most ignores need to be determined at runtime.
@@ -970,7 +1280,7 @@ class LogmanTrace(object):
     logging.debug('Running: %s' % cmd)
     try:
       child = subprocess.Popen(cmd, cwd=cwd, stdout=stdout, stderr=stderr)
-      out, err = child.communicate()
+      out, err = communicate_tail(child)
     finally:
       # 3. Stop the log collection.
       cmd_stop = [
@@ -1015,74 +1325,161 @@ class LogmanTrace(object):
 
     if child.returncode != 0:
       print 'Failure: %d' % child.returncode
-      # pylint: disable=E1103
       if out:
-        print ''.join(out.splitlines(True)[-100:])
+        print out
       if err:
-        print ''.join(err.splitlines(True)[-100:])
+        print err
     return child.returncode
 
+  @staticmethod
+  def _ansi_csv_reader(ansi_csv_data, **kwargs):
+    """Loads an 'ANSI' code page and returns unicode() objects."""
+    assert sys.getfilesystemencoding() == 'mbcs'
+    encoding = get_current_encoding()
+    for row in csv.reader(ansi_csv_data, **kwargs):
+      # Decode str 'ansi' instances to unicode instances. Decoding the whole row
+      # at once is much faster than cell by cell. A cell can't contain a NUL and
+      # no code page uses it as a trail byte.
+      yield '\x00'.join(row).decode(encoding).split(u'\x00')
+
+  @classmethod
+  def _parse_csv_parallel(cls, filename, blacklist, jobs):
+    """Parses an 'ANSI' csv log with |jobs| processes, each handling a range of
+    lines.
+
+    The rows are independent of each other as far as the files touched are
+    concerned so the log can be split anywhere on a line boundary. |blacklist|
+    is sent to the processes so it must be picklable.
+
+    Returns the merged _Context._paths.
+    """
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with open(filename, 'rb') as f:
+      for i in xrange(1, jobs):
+        f.seek(max(size * i / jobs, offsets[-1]))
+        # Skip to the beginning of the next line.
+        f.readline()
+        offsets.append(f.tell())
+    offsets.append(size)
+    pool = multiprocessing.Pool(jobs)
+    try:
+      results = pool.map(
+          _logman_parse_csv_range,
+          [
+            (filename, blacklist, offsets[i], offsets[i+1])
+            for i in xrange(jobs)
+          ])
+    finally:
+      pool.terminate()
+    paths = {}
+    for result in results:
+      paths.update(result)
+    return paths
+
   @classmethod
   def parse_log(cls, filename, blacklist):
     logging.info('parse_log(%s, %s)' % (filename, blacklist))
 
-    # Auto-detect the log format
-    with open(filename, 'rb') as f:
-      hdr = f.read(2)
+    with open(filename, 'rb', LOG_BUFFER_SIZE) as logfile:
+      # Auto-detect the log format
+      hdr = logfile.read(2)
       assert len(hdr) == 2
       if hdr == '<E':
         # It starts with <Events>
         logformat = 'xml'
-      elif hdr == '\xFF\xEF':
+      elif hdr == '\xFF\xFE':
         # utf-16 BOM.
         logformat = 'csv_utf16'
       else:
         logformat = 'csv'
+      # Reuse the same file object to parse the log.
+      logfile.seek(0)
+
+      context = cls._Context(blacklist)
+      # Bind the method once, it is called for each line of the log.
+      on_csv_line = context.on_csv_line
+
+      if logformat == 'csv_utf16':
+        def utf_8_lines(utf_16_file):
+          """Transcodes the utf-16 file to utf-8 encoded str lines.
+
+          The file is transcoded one large block at a time, which is much
+          faster than reading it line by line through codecs.open().
+          """
+          decoder = codecs.getincrementaldecoder('utf-16')()
+          pending = ''
+          while True:
+            data = utf_16_file.read(LOG_BUFFER_SIZE)
+            pending += decoder.decode(data, not data).encode('utf-8')
+            lines = pending.splitlines(True)
+            # The last line may not be complete until the end of the file.
+            pending = lines.pop() if data and lines else ''
+            for line in lines:
+              yield line
+            if not data:
+              break
+
+        def unicode_csv_reader(utf_16_file, **kwargs):
+          """Transcodes temporarily as UTF-8 since csv module doesn't do
+          unicode.
+          """
+          for row in csv.reader(utf_8_lines(utf_16_file), **kwargs):
+            # Decode str utf-8 instances back to unicode instances. Decoding the
+            # whole row at once is much faster than cell by cell. A cell can't
+            # contain a NUL.
+            yield '\x00'.join(row).decode('utf-8').split(u'\x00')
+
+        for line in unicode_csv_reader(logfile):
+          # line is a list of unicode objects
+          on_csv_line(line)
+
+      elif logformat == 'csv':
+        jobs = multiprocessing.cpu_count()
+        if jobs > 1 and os.path.getsize(filename) >= cls.PARALLEL_PARSE_SIZE:
+          context.merge(cls._parse_csv_parallel(filename, blacklist, jobs))
+        else:
+          # The fastest and smallest format but only supports 'ANSI' file
+          # paths. E.g. the filenames are encoding in the 'current' encoding.
+          for line in cls._ansi_csv_reader(logfile):
+            # line is a list of unicode objects
+            on_csv_line(line)
 
-    context = cls._Context(blacklist)
+      else:
+        raise NotImplementedError('Implement %s' % logformat)
 
-    if logformat == 'csv_utf16':
-      def utf_8_encoder(unicode_csv_data):
-        """Encodes the unicode object as utf-8 encoded str instance"""
-        for line in unicode_csv_data:
-          yield line.encode('utf-8')
-
-      def unicode_csv_reader(unicode_csv_data, **kwargs):
-        """Encodes temporarily as UTF-8 since csv module doesn't do unicode."""
-        csv_reader = csv.reader(utf_8_encoder(unicode_csv_data), **kwargs)
-        for row in csv_reader:
-          # Decode str utf-8 instances back to unicode instances, cell by cell:
-          yield [cell.decode('utf-8') for cell in row]
-
-      # The CSV file is UTF-16 so use codecs.open() to load the file into the
-      # python internal unicode format (utf-8). Then explicitly re-encode as
-      # utf8 as str instances so csv can parse it fine. Then decode the utf-8
-      # str back into python unicode instances. This sounds about right.
-      for line in unicode_csv_reader(codecs.open(filename, 'r', 'utf-16')):
-        # line is a list of unicode objects
-        context.on_csv_line(line)
-
-    elif logformat == 'csv':
-      def ansi_csv_reader(ansi_csv_data, **kwargs):
-        """Loads an 'ANSI' code page and returns unicode() objects."""
-        assert sys.getfilesystemencoding() == 'mbcs'
-        encoding = get_current_encoding()
-        for row in csv.reader(ansi_csv_data, **kwargs):
-          # Decode str 'ansi' instances to unicode instances, cell by cell:
-          yield [cell.decode(encoding) for cell in row]
-
-      # The fastest and smallest format but only supports 'ANSI' file paths.
-      # E.g. the filenames are encoding in the 'current' encoding.
-      for line in ansi_csv_reader(open(filename)):
-        # line is a list of unicode objects
-        context.on_csv_line(line)
+    dirs = {}
+    return (
+        realpaths(context.files, dirs),
+        realpaths(context.non_existent, dirs))
 
-    else:
-      raise NotImplementedError('Implement %s' % logformat)
 
-    return (
-        set(os.path.realpath(f) for f in context.files),
-        set(os.path.realpath(f) for f in context.non_existent))
+def _logman_parse_csv_range(args):
+  """Parses the lines of an 'ANSI' csv log between the |start| and |end| byte
+  offsets.
+
+  Runs in a multiprocessing.Pool worker so it must be a module level function.
+  See LogmanTrace._parse_csv_parallel().
+  """
+  filename, blacklist, start, end = args
+  context = LogmanTrace._Context(blacklist)  # pylint: disable=W0212
+  # Only the first range contains the header line.
+  context._first_line = start != 0  # pylint: disable=W0212
+  on_csv_line = context.on_csv_line
+  with open(filename, 'rb', LOG_BUFFER_SIZE) as logfile:
+    logfile.seek(start)
+    def lines():
+      """Yields the lines up to |end|."""
+      remaining = end - start
+      while remaining > 0:
+        line = logfile.readline()
+        if not line:
+          break
+        remaining -= len(line)
+        yield line
+    for line in LogmanTrace._ansi_csv_reader(lines()):  # pylint: disable=W0212
+      on_csv_line(line)
+  return context._paths  # pylint: disable=W0212
 
 
 def relevant_files(files, root):
@@ -1090,33 +1487,67 @@ def relevant_files(files, root):
 
   Unexpected files are files that are not based inside the |root| directory.
   """
-  expected = []
-  unexpected = []
+  expected = set()
+  unexpected = set()
+  root_len = len(root)
   for f in files:
     if f.startswith(root):
-      f = f[len(root):]
+      f = f[root_len:]
       assert f
-      expected.append(f)
+      expected.add(f)
     else:
-      unexpected.append(f)
-  return sorted(set(expected)), sorted(set(unexpected))
+      unexpected.add(f)
+  return sorted(expected), sorted(unexpected)
 
 
 def extract_directories(files, root):
   """Detects if all the files in a directory were loaded and if so, replace the
   individual files by the directory entry.
+
+  A directory whose files and subdirectories were all loaded is replaced too.
   """
-  directories = set(os.path.dirname(f) for f in files)
   files = set(files)
-  for directory in sorted(directories, reverse=True):
-    actual = set(
-      os.path.join(directory, f) for f in
-      os.listdir(os.path.join(root, directory))
-      if not f.endswith(('.svn', '.pyc'))
-    )
-    if not (actual - files):
-      files -= actual
-      files.add(directory + os.path.sep)
+  # Names of the files and directories loaded, grouped by directory.
+  directories = {}
+  for f in files:
+    directory, name = os.path.split(f)
+    directories.setdefault(directory, set()).add(name)
+  # Process the deepest directories first so a replaced directory counts as
+  # loaded in its parent.
+  depth = lambda d: d.count(os.path.sep) if d else -1
+  pending = [(-depth(d), d) for d in directories]
+  heapq.heapify(pending)
+  # Directories that can't be replaced since one of their subdirectories wasn't.
+  blocked = set()
+  while pending:
+    directory = heapq.heappop(pending)[1]
+    replaced = False
+    if directory not in blocked:
+      loaded = directories[directory]
+      actual = [
+        f for f in os.listdir(os.path.join(root, directory))
+        if not f.endswith(('.svn', '.pyc'))
+      ]
+      # Skip the set operations when the directory has more entries than files
+      # loaded from it.
+      if len(actual) <= len(loaded) and loaded.issuperset(actual):
+        for f in actual:
+          f = os.path.join(directory, f)
+          files.discard(f)
+          files.discard(f + os.path.sep)
+        files.add(directory + os.path.sep)
+        replaced = True
+    if not directory:
+      continue
+    parent, name = os.path.split(directory)
+    if replaced:
+      if parent not in directories:
+        directories[parent] = set()
+        heapq.heappush(pending, (-depth(parent), parent))
+      directories[parent].add(name)
+    elif not name.endswith(('.svn', '.pyc')):
+      # No need to list the parent directory.
+      blocked.add(parent)
   return sorted(files)
 
 
@@ -1130,6 +1561,10 @@ def pretty_print(variables, stdout):
       'variables', 'condition', 'command', 'relative_cwd', 'read_only',
       KEY_TRACKED, KEY_UNTRACKED)
 
+  # Buffer the output and write it at once.
+  out = []
+  write = out.append
+
   def sorting_key(x):
     """Gives priority to 'most important' keys before the others."""
     if x in ORDER:
@@ -1139,55 +1574,78 @@ def pretty_print(variables, stdout):
   def loop_list(indent, items):
     for item in items:
       if isinstance(item, basestring):
-        stdout.write('%s\'%s\',\n' % (indent, item))
+        write('%s\'%s\',\n' % (indent, item))
       elif isinstance(item, dict):
-        stdout.write('%s{\n' % indent)
+        write('%s{\n' % indent)
         loop_dict(indent + '  ', item)
-        stdout.write('%s},\n' % indent)
+        write('%s},\n' % indent)
       elif isinstance(item, list):
         # A list inside a list will write the first item embedded.
-        stdout.write('%s[' % indent)
+        write('%s[' % indent)
         for index, i in enumerate(item):
           if isinstance(i, basestring):
-            stdout.write(
+            # A python 2 str translate table can't map a character to two and a
+            # single re.sub() pass is much slower than two str.replace().
+            write(
                 '\'%s\', ' % i.replace('\\', '\\\\').replace('\'', '\\\''))
           elif isinstance(i, dict):
-            stdout.write('{\n')
+            write('{\n')
             loop_dict(indent + '  ', i)
             if index != len(item) - 1:
               x = ', '
             else:
               x = ''
-            stdout.write('%s}%s' % (indent, x))
+            write('%s}%s' % (indent, x))
           else:
             assert False
-        stdout.write('],\n')
+        write('],\n')
       else:
         assert False
 
   def loop_dict(indent, items):
     for key in sorted(items, key=sorting_key):
       item = items[key]
-      stdout.write("%s'%s': " % (indent, key))
+      write("%s'%s': " % (indent, key))
       if isinstance(item, dict):
-        stdout.write('{\n')
+        write('{\n')
         loop_dict(indent + '  ', item)
-        stdout.write(indent + '},\n')
+        write(indent + '},\n')
       elif isinstance(item, list):
-        stdout.write('[\n')
+        write('[\n')
         loop_list(indent + '  ', item)
-        stdout.write(indent + '],\n')
+        write(indent + '],\n')
       elif isinstance(item, basestring):
-        stdout.write(
+        write(
             '\'%s\',\n' % item.replace('\\', '\\\\').replace('\'', '\\\''))
       elif item in (True, False, None):
-        stdout.write('%s\n' % item)
+        write('%s\n' % item)
       else:
         assert False, item
 
-  stdout.write('{\n')
+  write('{\n')
   loop_dict('  ', variables)
-  stdout.write('}\n')
+  write('}\n')
+  stdout.write(''.join(out))
+
+
+class Blacklist(object):
+  """Strips ignored paths.
+
+  It is a class instead of a closure so it can be pickled to the processes
+  parsing a large log.
+  """
+  GIT_PATH = os.path.sep + '.git' + os.path.sep
+  SVN_PATH = os.path.sep + '.svn' + os.path.sep
+
+  def __init__(self, ignored):
+    self.ignored = ignored
+
+  def __call__(self, f):
+    return (
+        f.startswith(self.ignored) or
+        f.endswith('.pyc') or
+        self.GIT_PATH in f or
+        self.SVN_PATH in f)
 
 
 def trace_inputs(logfile, cmd, root_dir, cwd_dir, product_dir, force_trace):
@@ -1262,18 +1720,8 @@ def trace_inputs(logfile, cmd, root_dir, cwd_dir, product_dir, force_trace):
     if returncode and not force_trace:
       return returncode
 
-  git_path = os.path.sep + '.git' + os.path.sep
-  svn_path = os.path.sep + '.svn' + os.path.sep
-  def blacklist(f):
-    """Strips ignored paths."""
-    return (
-        f.startswith(api.IGNORED) or
-        f.endswith('.pyc') or
-        git_path in f or
-        svn_path in f)
-
   print_if('Loading traces... %s' % logfile)
-  files, non_existent = api.parse_log(logfile, blacklist)
+  files, non_existent = api.parse_log(logfile, Blacklist(api.IGNORED))
 
   print_if('Total: %d' % len(files))
   print_if('Non existent: %d' % len(non_existent))
@@ -1317,6 +1765,10 @@ def trace_inputs(logfile, cmd, root_dir, cwd_dir, product_dir, force_trace):
 
       if product_dir and f.startswith(product_dir):
         return '<(PRODUCT_DIR)/%s' % f[len(product_dir):]
+      elif f.startswith(cwd_dir):
+        # Most files are inside cwd_dir. Since cwd_dir is empty or ends with a
+        # '/', stripping it is the same as posix_relpath().
+        return f[len(cwd_dir):] or './'
       else:
         # cwd_dir is usually the directory containing the gyp file. It may be
         # empty if the whole directory containing the gyp file is needed.
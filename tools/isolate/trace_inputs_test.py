@@ -4,17 +4,49 @@
 # found in the LICENSE file.
 
 import cStringIO
+import csv
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
 import trace_inputs
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
 
 class TraceInputs(unittest.TestCase):
+  def setUp(self):
+    # Resolved so the paths parse_log() returns can be compared with it.
+    self.tempdir = os.path.realpath(tempfile.mkdtemp(prefix='trace_inputs'))
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
   def _test(self, value, expected):
     actual = cStringIO.StringIO()
     trace_inputs.pretty_print(value, actual)
     self.assertEquals(expected, actual.getvalue())
 
+  def _test_parse_log_parallel(
+      self, api, logname, blacklist, expected, jobs=3):
+    """Verifies that parsing the log with |jobs| processes gives the same
+    result as parsing it in a single process.
+    """
+    self.assertEquals(expected, api.parse_log(logname, blacklist))
+    old_parallel_parse_size = api.PARALLEL_PARSE_SIZE
+    old_cpu_count = multiprocessing.cpu_count
+    api.PARALLEL_PARSE_SIZE = 0
+    multiprocessing.cpu_count = lambda: jobs
+    try:
+      self.assertEquals(expected, api.parse_log(logname, blacklist))
+    finally:
+      api.PARALLEL_PARSE_SIZE = old_parallel_parse_size
+      multiprocessing.cpu_count = old_cpu_count
+
   def test_pretty_print_empty(self):
     self._test({}, '{\n}\n')
 
@@ -88,6 +120,195 @@ class TraceInputs(unittest.TestCase):
         "}\n")
     self._test(value, expected)
 
+  def test_strace_context(self):
+    # pylint: disable=W0212
+    context = trace_inputs.Strace._Context(lambda _: False)
+    lines = [
+      '42 chdir("%s") = 0' % BASE_DIR,
+      '42 --- SIGCHLD (Child exited) @ 0 (0) ---',
+      '42 open("trace_inputs.py", O_RDONLY <unfinished ...>',
+      '42 <... open resumed> ) = 3',
+      '42 open("non_existent", O_RDONLY) = -1 ENOENT (No such file)',
+      '42 open("data", O_RDONLY|O_DIRECTORY) = 3',
+      '42 open("new_file", O_WRONLY|O_CREAT, 0644) = 3',
+      '42 +++ killed by SIGKILL +++',
+    ]
+    for line in lines:
+      context.on_line(line + '\n')
+    self.assertEquals(
+        set([os.path.join(BASE_DIR, 'trace_inputs.py')]), context.files)
+    self.assertEquals(
+        set([os.path.join(BASE_DIR, 'new_file')]), context.non_existent)
+
+  def test_strace_parse_log_parallel(self):
+    lines = [
+      '42 chdir("%s") = 0' % BASE_DIR,
+      '42 clone(child_stack=0, flags=SIGCHLD) = 43',
+      '42 open("trace_inputs.py", O_RDONLY) = 3',
+      '43 chdir("data") = 0',
+      '42 chdir("/") = 0',
+      '43 open("../isolate.py", O_RDONLY <unfinished ...>',
+      '42 open("non_existent", O_RDONLY) = 3',
+      '43 <... open resumed> ) = 3',
+      '43 open("non_existent", O_RDONLY) = 3',
+      '43 open("/usr/non_existent", O_RDONLY) = 3',
+      '43 exit_group(0) = ?',
+    ]
+    expected = (
+      set([
+        os.path.join(BASE_DIR, 'isolate.py'),
+        os.path.join(BASE_DIR, 'trace_inputs.py'),
+      ]),
+      set([
+        '/non_existent',
+        os.path.join(BASE_DIR, 'data', 'non_existent'),
+      ]),
+    )
+    logname = os.path.join(self.tempdir, 'strace.log')
+    with open(logname, 'w') as f:
+      f.write('\n'.join(lines) + '\n')
+    self._test_parse_log_parallel(
+        trace_inputs.Strace, logname, trace_inputs.Blacklist(('/usr',)),
+        expected)
+
+  def test_strace_symlink_pardir(self):
+    if not hasattr(os, 'symlink'):
+      return
+    # '..' must be resolved after the symlink, not collapsed textually.
+    os.makedirs(os.path.join(self.tempdir, 'real', 'sub'))
+    os.mkdir(os.path.join(self.tempdir, 'work'))
+    open(os.path.join(self.tempdir, 'real', 'target.h'), 'w').close()
+    os.symlink(
+        os.path.join(self.tempdir, 'real', 'sub'),
+        os.path.join(self.tempdir, 'work', 'link'))
+    logname = os.path.join(self.tempdir, 'strace.log')
+    with open(logname, 'w') as f:
+      f.write(
+          '42 chdir("%s") = 0\n'
+          '42 open("link/../target.h", O_RDONLY) = 3\n' %
+          os.path.join(self.tempdir, 'work'))
+    self.assertEquals(
+        (set([os.path.join(self.tempdir, 'real', 'target.h')]), set()),
+        trace_inputs.Strace.parse_log(logname, lambda _: False))
+
+  def test_dtrace_sort_log(self):
+    lines = [
+      '0 1:100 chdir("%s") = 0' % BASE_DIR,
+      '1 1:100 dtrace_BEGIN() = 0',
+      '2 100:101 proc_start("python", 2) = 0',
+      '3 100:101 open("trace_inputs.py", 0, 0) = 0',
+      '4 100:101 open("non_existent", 0, 0) = 2',
+      '5 100:101 proc_exit("python", 1) = 0',
+    ]
+    logname = os.path.join(self.tempdir, 'dtrace.log')
+    with open(logname, 'w') as f:
+      # dtrace writes its buffers out of order and the log ends with a blank
+      # line.
+      f.write('\n'.join(lines[3:] + lines[:3]) + '\n\n')
+    trace_inputs.Dtrace._sort_log(logname)  # pylint: disable=W0212
+    with open(logname) as f:
+      self.assertEquals('\n'.join(lines) + '\n', f.read())
+    self.assertEquals(
+        (set([os.path.join(BASE_DIR, 'trace_inputs.py')]), set()),
+        trace_inputs.Dtrace.parse_log(logname, lambda _: False))
+
+  def test_logman_parse_log_parallel(self):
+    if sys.platform != 'win32':
+      return
+    header = [
+      'Event Name', 'Type', 'Event ID', 'Version', 'Channel', 'Level',
+      'Opcode', 'Task', 'Keyword', 'PID', 'TID', 'Processor Number',
+      'Instance ID', 'Parent Instance ID', 'Activity ID',
+      'Related Activity ID', 'Clock-Time', 'Kernel(ms)', 'User(ms)',
+      'User Data',
+    ]
+    def row(event_name, event_type, pid, values=None):
+      """Returns an event row with the columns that never change filled in."""
+      out = [
+        event_name, event_type, '0', '2', '0', '0', '0', '0',
+        '0x0000000000000000', pid, '0x1', '0', '', '',
+        '{00000000-0000-0000-0000-000000000000}', '', '1', '0', '0', '',
+      ] + [''] * 8
+      for index, value in (values or {}).iteritems():
+        out[index] = value
+      return out
+
+    nt_dir = trace_inputs.QueryDosDevice(BASE_DIR[:2]) + BASE_DIR[2:]
+    names = ['isolate.py', 'trace_inputs.py', 'non, existent.txt']
+    rows = [
+      header,
+      row('EventTrace', 'Header', '0x0'),
+      row('Process', 'DCStart', '0x10', {21: '0x64', 26: '"logman.exe"'}),
+      row('Process', 'Start', '0x64', {20: '0x65', 26: '"python.exe"'}),
+    ]
+    for i in xrange(30):
+      path = '"%s\\%s"' % (nt_dir, names[i % len(names)])
+      rows.append(row('FileIo', 'Create', '0x65', {25: path}))
+    rows.append(row('Process', 'End', '0x64'))
+    expected = (
+      set([
+        os.path.join(BASE_DIR, 'isolate.py').lower(),
+        os.path.join(BASE_DIR, 'trace_inputs.py').lower(),
+      ]),
+      set([os.path.join(BASE_DIR, 'non, existent.txt').lower()]),
+    )
+    logname = os.path.join(self.tempdir, 'logman.csv')
+    with open(logname, 'wb') as f:
+      csv.writer(f).writerows(rows)
+    # The ranges are split at different offsets for each number of jobs,
+    # including in the middle of the quoted paths.
+    for jobs in xrange(2, 8):
+      self._test_parse_log_parallel(
+          trace_inputs.LogmanTrace, logname, trace_inputs.Blacklist(()),
+          expected, jobs)
+
+  def test_extract_directories(self):
+    for path in ('a/b/c/x', 'a/b/y', 'a/z', 'd/w', 'd/v'):
+      path = os.path.join(self.tempdir, *path.split('/'))
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      open(path, 'w').close()
+    files = [
+      os.path.join('a', 'b', 'c', 'x'),
+      os.path.join('a', 'b', 'y'),
+      os.path.join('a', 'z'),
+      os.path.join('d', 'w'),
+    ]
+    expected = [
+      os.path.join('a', ''),
+      os.path.join('d', 'w'),
+    ]
+    self.assertEquals(
+        expected, trace_inputs.extract_directories(files, self.tempdir))
+
+  def test_realpaths(self):
+    paths = [
+      os.path.join(BASE_DIR, 'trace_inputs.py'),
+      os.path.join(BASE_DIR, 'data', '..', 'trace_inputs_test.py'),
+      os.path.join(BASE_DIR, 'non_existent'),
+      os.path.join(BASE_DIR, 'data', '.'),
+    ]
+    expected = set(os.path.realpath(p) for p in paths)
+    self.assertEquals(expected, trace_inputs.realpaths(paths))
+
+  def test_communicate_tail(self):
+    child = subprocess.Popen(
+        [
+          sys.executable, '-c',
+          'import sys\n'
+          'data = sys.stdin.read()\n'
+          'for i in xrange(1000):\n'
+          '  print >> sys.stdout, data, i\n'
+          '  print >> sys.stderr, i\n',
+        ],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    out, err = trace_inputs.communicate_tail(child, 'Go!', 3)
+    self.assertEquals(0, child.returncode)
+    self.assertEquals('Go! 997\nGo! 998\nGo! 999\n', out.replace('\r\n', '\n'))
+    self.assertEquals('997\n998\n999\n', err.replace('\r\n', '\n'))
+
 
 if __name__ == '__main__':
   unittest.main()